@@ -1,6 +1,8 @@
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
 import json
+import hashlib
 
 # Initialize Firebase (if not already initialized)
 try:
@@ -64,26 +66,67 @@ class Article:
             filenames=set(data["filenames"])
         )
 
+    @property
+    def document_id(self) -> str:
+        """Firestore document ID: SHA-1 of the DOI, or the title for articles without a DOI."""
+        if self.doi and self.doi != "no doi":
+            return hashlib.sha1(Article.normalize_doi(self.doi).encode()).hexdigest()
+        return self.name
+
+    @staticmethod
+    def normalize_doi(doi: str) -> str:
+        """DOIs are case-insensitive, so compare and hash them stripped and lower-cased."""
+        return (doi or "").strip().lower()
+
+    def stored_document_id(self) -> str:
+        """
+        Finds the ID of the Firestore document holding this article.
+        Articles saved before DOI-derived IDs are keyed by title, so these are looked up by DOI.
+
+        :return: The ID of the existing document with this DOI, otherwise document_id
+        """
+        if self.doi and self.doi != "no doi":
+            return Article.find_document_id_by_doi(self.doi) or self.document_id
+        return self.document_id
+
     def save_to_firestore(self):
-        """Saves the Article object to Firestore. Prevents overwriting if DOI already exists."""
-        articles_ref = db.collection("Articles")
-    
-        # 🔹 Check if a document with this DOI already exists
-        existing_docs = articles_ref.where("doi", "==", self.doi).stream()
-    
-        for doc in existing_docs:
-            # ✅ If a matching DOI is found, update the existing entry instead of overwriting
-            doc_ref = articles_ref.document(doc.id)  # Keep the existing document ID
-            doc_ref.update(self.to_dict())  # Update only new fields
-            print(f"🔄 Updated existing article with DOI '{self.doi}' in Firestore.")
-            return  # Stop execution since the update is done
-
-        # 🆕 If no matching DOI is found, create a new document
-        doc_ref = articles_ref.document(self.name)
-        doc_ref.set(self.to_dict())  # Create a new entry
+        """Saves the Article object to Firestore. Merges into the existing document if the DOI is already stored."""
+        # 🔹 Use the existing document (also a legacy title-keyed one), so no duplicate DOI is created
+        doc_ref = db.collection("Articles").document(self.stored_document_id())
+        doc_ref.set(self.to_dict(), merge=True)  # Creates the entry or updates only the given fields
         print(f"✅ Article '{self.name}' saved to Firestore.")
-    
-    
+
+    def add_to_bulk_writer(self, bulk_writer):
+        """
+        Queues the Article object for writing under document_id through a Firestore BulkWriter.
+        No lookup is done, so only use this for DOIs not yet stored (e.g. not in Article.load_all_dois()).
+
+        :param bulk_writer: BulkWriter created with Article.bulk_writer()
+        """
+        doc_ref = db.collection("Articles").document(self.document_id)
+        bulk_writer.set(doc_ref, self.to_dict(), merge=True)
+        print(f"📦 Article '{self.name}' queued for Firestore.")
+
+    @staticmethod
+    def bulk_writer():
+        """Creates a Firestore BulkWriter that batches and parallelises article writes."""
+        return db.bulk_writer()
+
+    @staticmethod
+    def find_document_id_by_doi(doi: str):
+        """
+        Looks up the ID of the Firestore document that stores a particular DOI.
+
+        :param doi: The DOI to look up
+        :return: The document ID if the DOI is stored, otherwise None
+        """
+        # 🔥 Query Firestore for at most one article with the given DOI, without its fields
+        docs = db.collection("Articles").where(filter=FieldFilter("doi", "==", doi)).limit(1).select([]).stream()
+
+        for doc in docs:
+            return doc.id  # ✅ DOI found, return its document ID
+        return None  # ❌ DOI not found
+
     @staticmethod
     def does_doi_exist(doi: str) -> bool:
         """
@@ -92,33 +135,40 @@ class Article:
         :param doi: The DOI to check
         :return: True if DOI exists, False otherwise
         """
-        # 🔥 Query Firestore for articles with the given DOI
-        docs = db.collection("Articles").where("doi", "==", doi).stream()
-
-        for doc in docs:
-            return True  # ✅ DOI found, return True
-        return False  # ❌ DOI not found, return False
+        return Article.find_document_id_by_doi(doi) is not None
             
     @classmethod
-    def load_from_firestore(cls, name):
-        """Retrieves an Article from Firestore."""
-        doc_ref = db.collection("Articles").document(name)
+    def load_all_dois(cls) -> set:
+        """
+        Fetches every DOI currently stored in Firestore in a single stream.
+
+        :return: Set of normalized DOIs (see Article.normalize_doi) present in the Articles collection
+        """
+        # 🔥 Only request the 'doi' field to keep the payload small
+        docs = db.collection("Articles").select(["doi"]).stream()
+
+        return {Article.normalize_doi(doc.to_dict()["doi"]) for doc in docs if "doi" in doc.to_dict()}
+
+    @classmethod
+    def load_from_firestore(cls, document_id):
+        """Retrieves an Article from Firestore by its document ID (see Article.document_id)."""
+        doc_ref = db.collection("Articles").document(document_id)
         doc = doc_ref.get()
         if doc.exists:
             return cls.from_dict(doc.to_dict())
         else:
-            print(f"❌ Article '{name}' not found in Firestore.")
+            print(f"❌ Article '{document_id}' not found in Firestore.")
             return None
 
     def update_firestore(self):
         """Updates an existing Firestore record."""
-        doc_ref = db.collection("Articles").document(self.name)
+        doc_ref = db.collection("Articles").document(self.stored_document_id())
         doc_ref.update(self.to_dict())
         print(f"🔄 Article '{self.name}' updated in Firestore.")
 
     def delete_from_firestore(self):
         """Deletes the article from Firestore."""
-        db.collection("Articles").document(self.name).delete()
+        db.collection("Articles").document(self.stored_document_id()).delete()
         print(f"❌ Article '{self.name}' deleted from Firestore.")
 
     def __str__(self):
@@ -1,25 +1,53 @@
 import os
+import json
+import asyncio
+import hashlib
+import diskcache
+import httpx
 import openai
-import pypdf
-import nltk
-from nltk.tokenize import sent_tokenize
+import tempfile
+import threading
+import pymupdf
 from dotenv import load_dotenv
 from article import Article
 from criteria import CriteriaStore
 
-from habanero import Crossref
-
 
 # Load API key from .env file
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-# Ensure NLTK dependencies are available
-nltk.download('punkt')
+# 🔹 Async OpenAI client shared by every call, so its HTTP connection pool is reused
+client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# 🔹 Maximum number of articles processed at the same time
+MAX_CONCURRENCY = 16
+
+# 🔹 Shared HTTP/2 client for Crossref, multiplexing concurrent title lookups over one connection
+http = httpx.AsyncClient(http2=True, timeout=10, limits=httpx.Limits(max_connections=32))
+
+# 🔹 Small model for the simple title extraction, larger model for classification and criteria
+TITLE_MODEL = "gpt-4o-mini"
+METHOD_MODEL = "gpt-4o"
+
+# 🔹 Shared system message for all chat completion calls
+SYSTEM_PROMPT = "You are an assistant that analyses software engineering research papers. Answer exactly in the requested format."
+
+# 🔹 Directory holding extracted PDF text, keyed by file MD5
+PDF_CACHE_DIR = "./.pdfcache"
+
+# 🔹 PyMuPDF does not support use from multiple threads, so all PDF parsing is serialised
+PDF_LOCK = threading.Lock()
+
+# 🔹 Manifest of processed files, so unchanged files are skipped on re-runs
+MANIFEST_FILE = ".processed.json"
+
+# 🔹 Disk-backed cache of OpenAI answers, so re-runs skip identical requests
+openai_cache = diskcache.Cache("./.openai-cache")
 
 # 📌 Define research method categories
 RESEARCH_METHODS = [
-    "Data Science"
+    "Data Science",
     "Engineering Research",
     "Design Science",
     "Experiments",
@@ -37,215 +65,382 @@ RESEARCH_METHODS = [
     "Systematic Review"
 ]
 
+# 🔹 Built once: the allowed labels and the instruction shared by every classification request
+METHODS_JOINED = ", ".join(RESEARCH_METHODS)
+CLASSIFY_PROMPT_TEMPLATE = (
+    f"Classify the research method of this research paper, based on exactly these research methods {METHODS_JOINED}. "
+    'Return only JSON: {"research_method": "<method>"}'
+)
 
-def extract_text_from_pdf(pdf_path, max_chars=4000):
-    """Extracts text from a PDF file, limiting to max_chars for efficiency."""
-    pdf_reader = pypdf.PdfReader(pdf_path)
-    text = ""
 
-    for page in pdf_reader.pages:
-        text += page.extract_text() + "\n"
+def _extract_text(pdf_path, max_chars):
+    """
+    Extracts up to max_chars of text from a PDF file, stopping at the first page that reaches the limit.
+    Results are cached on disk per file MD5 and max_chars.
+    """
+    with open(pdf_path, "rb") as f:
+        md5 = hashlib.file_digest(f, "md5").hexdigest()  # Hashed in chunks, not read into memory at once
+
+    # ✅ Reuse text extracted in an earlier run
+    cache_file = os.path.join(PDF_CACHE_DIR, f"{md5}-{max_chars}.txt")
+    if os.path.exists(cache_file):
+        with open(cache_file, mode="r", encoding="utf-8") as f:
+            return f.read()
+
+    with PDF_LOCK, pymupdf.open(pdf_path) as doc:
+        out = []
+        total = 0
 
-    # Tokenize and limit the text length
-    sentences = sent_tokenize(text)
-    trimmed_text = " ".join(sentences[:max_chars // 20])  # Approximate sentence count
+        for page in doc:
+            page_text = page.get_text("text")  # Plain text only; image blocks are never collected
+            out.append(page_text)
+            total += len(page_text)  # 🔹 Running total instead of re-summing all pages
+            if total >= max_chars:
+                break  # 🔹 Enough text, skip the remaining pages
 
-    return trimmed_text
+    text = " ".join(out)[:max_chars]
 
-def classify_research_method(pdf_path, model="gpt-4-turbo"):
+    # 🔹 Write to a unique temp file and move it into place, so a cache file is never partially written
+    os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=PDF_CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, mode="w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_file, cache_file)
+
+    return text
+
+def extract_text_from_pdf(pdf_path, max_chars=4000):
+    """Extracts text from a PDF file, limiting to max_chars for efficiency."""
+    return _extract_text(pdf_path, max_chars)
+
+async def classify_research_method(pdf_path, model=METHOD_MODEL):
     """Classifies a research article using OpenAI GPT API (Latest Version)."""
     # Step 1: Extract text from PDF
-    article_text = extract_text_from_pdf(pdf_path)
+    article_text = await asyncio.to_thread(extract_text_from_pdf, pdf_path)
 
     # Step 2: Construct structured prompt
     prompt = f"""
     Please classify the following text into one of the following research methods:
-    {", ".join(RESEARCH_METHODS)}.
+    {METHODS_JOINED}.
     
     Please provide your result as follows:
     Title: The article's title
     Resulting Method: The resulting method. If you do not find a result, please return "mixed method".
     
     Do not return anything else.
-
-    Article Text:
-    {article_text}
-    
     """
 
-    # Step 3: Initialize OpenAI client correctly
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    # Step 3: Call OpenAI API with the shared system message and the article text
+    return await chat(prompt, article_text=article_text, model=model)
 
-    # Step 4: Call OpenAI API
-    response = client.chat.completions.create(
-        model=model,
-        messages=[{"role": "user", "content": prompt}]
-    )
 
-    return response.choices[0].message.content.strip()
-
-
-def get_doi_by_title(title):
+async def get_doi_by_title(title):
     """
-    Searches for a DOI based on an article title using the Crossref API via the habanero package.
+    Searches for a DOI based on an article title using the Crossref REST API.
     :param title: The title of the article.
     :return: The DOI if found, otherwise None.
     """
-    cr = Crossref()
-    results = cr.works(query_bibliographic=title, rows=1)
-    
+    response = await http.get(
+        "https://api.crossref.org/works",
+        params={"query.bibliographic": title, "rows": 1, "select": "DOI"}  # Only return the DOI field
+    )
+    response.raise_for_status()
+    results = response.json()
+
     if results['message']['items']:
         return results['message']['items'][0].get('DOI')
-    
+
     return None
 
+def is_transient_error(error):
+    """Checks whether a failed Crossref request is worth retrying: network errors, rate limiting and server errors."""
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, httpx.TransportError)
+
+async def get_doi_with_backoff(title, attempts=4):
+    """
+    Retries get_doi_by_title with exponential backoff on transient errors; other errors are raised immediately.
+    :param title: The title of the article.
+    :param attempts: Maximum number of requests to send.
+    :return: The DOI if found, otherwise None.
+    """
+    delay = 0.25
+
+    for attempt in range(1, attempts + 1):
+        try:
+            return await get_doi_by_title(title)
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            if attempt == attempts or not is_transient_error(e):
+                raise
+            print(f"DOI retrieval failed, retrying in {delay}s.")
+            await asyncio.sleep(delay)  # ⏳ Other articles keep running while this one waits
+            delay = min(delay * 2, 4.0)
+
 # Example usage
 
 
 # 🔥 Run classification on a PDF
 
 directory = "./articles/"
-assistant_id = "asst_UqLB2dxyKWFXqrpTHMh05Eai"
 
-for filename in os.listdir(directory):
-    if not filename.lower().endswith(".pdf"):
-        continue  # Skip non-PDF files
 
-    filepath = os.path.join(directory, filename)
-    print(f"\n📄 Processing: {filepath}")
+async def chat(prompt, article_text=None, json_mode=False, model=METHOD_MODEL, validate=None):
+    """
+    Sends a single stateless chat completion request.
+
+    :param prompt: The instruction for the model
+    :param article_text: Optional article excerpt the prompt refers to
+    :param json_mode: Whether the model must answer with a JSON object
+    :param model: The OpenAI model to use
+    :param validate: Optional check that the answer has the expected content; only valid answers are cached
+    :return: The content of the model's answer
+    """
+    # 🔹 Fixed instructions first and the article last, so requests share the longest possible prefix
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+    if article_text:
+        messages.append({"role": "user", "content": f"Article Text:\n\n{article_text}"})
 
-    # 🔥 Step 1: Start a new OpenAI thread for this article
-    thread = openai.beta.threads.create()
-    thread_id = thread.id
-    print(f"✅ New Thread Created: {thread_id}")
+    kwargs = {"response_format": {"type": "json_object"}} if json_mode else {}
+    if json_mode and validate is None:
+        validate = lambda content: isinstance(json.loads(content), dict)
+    response = await cached_chat(model, messages, validate=validate, temperature=0, **kwargs)
 
-    # 🔹 Step 2: Extract a small portion of the PDF for title detection
-    pdf_excerpt = extract_text_from_pdf(filepath, max_chars=1000)
+    return response.strip()
+
+
+async def cached_chat(model, messages, validate=None, **kwargs):
+    """
+    Calls the chat completions API, reusing a cached answer for identical requests.
+
+    :param model: The OpenAI model to use
+    :param messages: The chat messages to send
+    :param validate: Optional check that the answer has the expected content; only valid answers are cached
+    :param kwargs: Further request parameters, part of the cache key
+    :return: The content of the model's answer, or an empty string if there is none
+    """
+    key = hashlib.sha256((model + json.dumps([messages, kwargs], sort_keys=True)).encode()).hexdigest()
 
-    # 🔥 Step 3: Ask OpenAI for the title
-    openai.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=f"Extract the title from this research paper:\n\n{pdf_excerpt}\n\nReturn only: Title: <title>"
+    cached = openai_cache.get(key)
+    if cached is not None:
+        return cached  # ✅ Cache hit, no API call needed
+
+    response = await client.chat.completions.create(model=model, messages=messages, **kwargs)
+    content = response.choices[0].message.content or ""  # Refused or filtered answers have no content
+
+    # 🔹 Only cache usable answers, so a bad one is requested again on the next run
+    if content.strip() and is_valid_answer(content, validate):
+        openai_cache.set(key, content)
+
+    return content
+
+
+def is_valid_answer(content, validate):
+    """Runs an answer validator, treating answers it cannot parse as invalid."""
+    if validate is None:
+        return True
+
+    try:
+        return bool(validate(content))
+    except (ValueError, TypeError, AttributeError):  # json.JSONDecodeError is a ValueError
+        return False
+
+
+def json_string_field(content, key):
+    """
+    Reads a string field from a JSON answer.
+
+    :param content: The model's JSON answer
+    :param key: The field to read
+    :return: The stripped value if it is a non-empty string, otherwise None
+    """
+    data = json.loads(content)
+    value = data.get(key) if isinstance(data, dict) else None
+
+    if not isinstance(value, str) or not value.strip():
+        return None
+    return value.strip()
+
+
+def parse_criteria_answers(content):
+    """
+    Reads the answers of a batched criteria prompt.
+
+    :param content: The model's JSON answer
+    :return: Dict of criterion number (as string) -> answer
+    :raises ValueError: If the answer is not an 'answers' list of objects
+    """
+    data = json.loads(content)
+    answers = data.get("answers") if isinstance(data, dict) else None
+
+    if not isinstance(answers, list) or not all(isinstance(a, dict) for a in answers):
+        raise ValueError(f"no list of answer objects in: {content}")
+    return {str(a.get("id")): a.get("answer") for a in answers}
+
+
+def load_manifest():
+    """Loads the manifest of processed files (filename -> {"mtime", "doi"}), or an empty one."""
+    if not os.path.exists(MANIFEST_FILE):
+        return {}
+
+    try:
+        with open(MANIFEST_FILE, mode="r", encoding="utf-8") as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        print(f"❌ {MANIFEST_FILE} is unreadable, processing all files again.")
+        return {}
+
+def save_manifest(manifest):
+    """Writes the manifest of processed files to disk, atomically so an interrupted run cannot truncate it."""
+    tmp_file = f"{MANIFEST_FILE}.tmp"
+    with open(tmp_file, mode="w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_file, MANIFEST_FILE)
+
+def record_processed(manifest, filename, mtime, doi):
+    """Marks a file as processed for the given DOI and persists the manifest."""
+    manifest[filename] = {"mtime": mtime, "doi": doi}
+    save_manifest(manifest)
+
+
+async def classify_and_store(filename, mtime, title, doi, article_text, bulk_writer, manifest):
+    """Classifies the research method of a new article, checks its criteria and queues it for Firestore."""
+    # 🔥 Step 4: Ask OpenAI for the research method, based on the longer excerpt
+    method_response = await chat(
+        CLASSIFY_PROMPT_TEMPLATE,
+        article_text=article_text,
+        json_mode=True,
+        validate=lambda content: json_string_field(content, "research_method") is not None
+    )
+    resulting_method = json_string_field(method_response, "research_method")
+    if resulting_method is None:
+        raise ValueError(f"no research method in answer: {method_response}")
+    print(f"🔹 Extracted Research Method: {resulting_method}")
+
+    # Here comes the big old set of questions for the resulting method
+    criteria_store = CriteriaStore()
+    criteria = criteria_store.is_criteria_available(resulting_method )
+    rmQuality = ""
+
+    if criteria:
+        print(f"\n✅ Criteria for {resulting_method}:")
+        prompt = criteria_store.generate_batched_prompt(resulting_method)
+        print(f"\n📌 Sending to OpenAI: {prompt}")
+
+        # 🔥 Send all criteria in one prompt, together with the article they apply to
+        response_text = await chat(prompt, article_text=article_text, json_mode=True, validate=parse_criteria_answers)
+        answers = parse_criteria_answers(response_text)
+
+        for i, c in enumerate(criteria, start=1):
+            yes_no_answer = answers.get(str(i))
+
+            if yes_no_answer not in ["Yes", "No"]:
+                yes_no_answer = "Unknown"
+            # Store result
+            rmQuality += f"{c['description']} {yes_no_answer}\n"
+
+            print(f"✅ Extracted: ({c['description']}, {yes_no_answer})")
+
+    else:
+        print(f"\n❌ No criteria found for {resulting_method}.")
+
+    # 🔹 Step 5: Store the article in Firestore
+    article = Article(
+        name=title,
+        research_method=resulting_method,
+        doi=doi if doi else "no doi",
+        articleQuality={},
+        rmQuality=rmQuality,
+        filenames={filename}
     )
 
-    # 🔄 Run the assistant
-    run = openai.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id)
+    article.add_to_bulk_writer(bulk_writer)
+    record_processed(manifest, filename, mtime, article.doi)
+
 
-    # ⏳ Wait for OpenAI to process
-    while run.status in ["queued", "in_progress"]:
-        run = openai.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+async def process(filename, known_dois, bulk_writer, manifest):
+    """Runs the full title / DOI / research method / criteria pipeline for one PDF."""
+    filepath = os.path.join(directory, filename)
+    mtime = os.path.getmtime(filepath)
 
-    # 🔥 Retrieve the title
-    messages = openai.beta.threads.messages.list(thread_id=thread_id)
-    title_response = messages.data[0].content[0].text.value
-    title = title_response.replace("Title: ", "").strip()
+    # ✅ Skip unchanged files whose article is already stored
+    entry = manifest.get(filename, {})
+    if entry.get("mtime") == mtime and Article.normalize_doi(entry.get("doi")) in known_dois:
+        print(f"\n⏭️ Skipping unchanged file: {filepath}")
+        return
+
+    print(f"\n📄 Processing: {filepath}")
+
+    # 🔹 Step 1: Extract the PDF once; the first part is enough for title detection
+    pdf_excerpt_longer = await asyncio.to_thread(extract_text_from_pdf, filepath, max_chars=5000)
+    pdf_excerpt = pdf_excerpt_longer[:1000]
+
+    # 🔥 Step 2: Ask OpenAI for the title
+    title_response = await chat(
+        'Extract the title from this research paper. Return only JSON: {"title": "<title>"}',
+        article_text=pdf_excerpt,
+        json_mode=True,
+        model=TITLE_MODEL,
+        validate=lambda content: json_string_field(content, "title") is not None
+    )
+    title = json_string_field(title_response, "title")
+    if title is None:
+        # ❌ An empty Crossref query would match an unrelated work, so stop here
+        print(f"❌ Sorry, no title found in {filepath}...")
+        return
     print(f"🔹 Extracted Title: {title}")
 
-    # 🔍 Step 4: Check if DOI exists in Firestore
-    try: 
-        doi = get_doi_by_title(title)
-    except:
-        print("DOI retrieval failed, let's try once more.")
-        doi = get_doi_by_title(title)
-        
+    # 🔍 Step 3: Check if DOI exists in Firestore
+    doi = await get_doi_with_backoff(title)
+
     if not doi:
         print("❌ Sorry, article's DOI not found by title...")
     else:
         print(f"✅ DOI found: {doi}")
-        if Article.does_doi_exist(doi): # in DB
+        doi_key = Article.normalize_doi(doi)  # 🔹 Same form as load_all_dois and the document ID
+        if doi_key in known_dois: # in DB
             print(f"Article already in DB, no need to extract RM")
-            resulting_method = ""
+            record_processed(manifest, filename, mtime, doi)
         else:
-            # 🔥 Step 5: Extract more of the PDF for research method classification
-            pdf_excerpt_longer = extract_text_from_pdf(filepath, max_chars=5000)
-
-        # 🔥 Ask OpenAI for the research method
-            openai.beta.threads.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=f"Classify the research method of this research paper, based on exactly these research methods {", ".join(RESEARCH_METHODS)}. :\n\n{pdf_excerpt_longer}\n\nReturn only: Resulting Method: <method>"
-            )
-
-            # 🔄 Run the assistant again
-            run = openai.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id)
-
-            # ⏳ Wait for completion
-            while run.status in ["queued", "in_progress"]:
-                run = openai.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-
-            # 🔥 Retrieve the research method
-            messages = openai.beta.threads.messages.list(thread_id=thread_id)
-            method_response = messages.data[0].content[0].text.value
-            resulting_method = method_response.replace("Resulting Method: ", "").strip()
-            print(f"🔹 Extracted Research Method: {resulting_method}")
-            
-            # Here comes the big old set of questions for the resulting method
-            criteria_store = CriteriaStore()
-            criteria = criteria_store.is_criteria_available(resulting_method )
-            rmQuality = ""
-            
-            if criteria:
-                print(f"\n✅ Criteria for {resulting_method}:")
-                for c in criteria:
-                        prompt = criteria_store.generate_prompt_for_criterion(resulting_method, c['description'])
-                        print(f"\n📌 Sending to OpenAI: {prompt}")
-
-                        # 🔥 Send a single prompt to OpenAI
-                        openai.beta.threads.messages.create(
-                            thread_id=thread_id,
-                            role="user",
-                            content=prompt
-                        )
-
-                        # 🔄 Run the assistant for just this one criterion
-                        run = openai.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id)
-
-                        # ⏳ Wait for OpenAI to complete processing
-                        while run.status in ["queued", "in_progress"]:
-                            run = openai.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-
-                        # 🔥 Retrieve the response
-                        messages = openai.beta.threads.messages.list(thread_id=thread_id)
-                        assistant_messages = [msg for msg in messages.data if msg.role == "assistant"]
-
-                        if assistant_messages:
-                            latest_message = max(assistant_messages, key=lambda msg: msg.created_at)  # Get the latest by timestamp
-                            print(latest_message)
-                            response_text = latest_message.content[0].text.value.strip()
-    
-                            yes_no_answer = response_text.split("\n")[-1].strip()  # Extract last line (Yes/No)
-    
-                            if yes_no_answer not in ["Yes", "No"]:
-                                yes_no_answer = "Unknown"
-                        else:
-                            yes_no_answer = "Unknown"
-                        # Store result
-                        rmQuality += f"{c['description']} {yes_no_answer}\n"
-                        
-                        print(f"✅ Extracted: ({c['description']}, {yes_no_answer})")
-
-                else:
-                    print(f"\n❌ No criteria found for {resulting_method}.")
-                    
-            
-
-    # 🔹 Step 6: Store the article in Firestore
-            article = Article(
-                name=title,
-                research_method=resulting_method,
-                doi=doi if doi else "no doi",
-                articleQuality={},
-                rmQuality=rmQuality,
-                filenames={filename}
-            )
-
-            article.save_to_firestore()
-
-    # 🔥 Step 7: Close the OpenAI thread (optional)
-    final_run = openai.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-    token_usage = final_run.usage  # Contains token info
-    print(final_run.usage)
-
-    openai.beta.threads.delete(thread_id)
-    print(f"✅ Thread {thread_id} closed.")
\ No newline at end of file
+            # 🔹 Claim the DOI before awaiting, so concurrent files with the same DOI take the branch above
+            known_dois.add(doi_key)
+            try:
+                await classify_and_store(filename, mtime, title, doi, pdf_excerpt_longer, bulk_writer, manifest)
+            except Exception:
+                known_dois.discard(doi_key)  # ❌ Release the claim so the article is processed again later
+                raise
+
+
+async def main():
+    """Processes all PDFs in the articles directory concurrently."""
+    # 🔥 Fetch all known DOIs once instead of querying Firestore per article
+    known_dois = Article.load_all_dois()
+    bulk_writer = Article.bulk_writer()
+    manifest = load_manifest()
+
+    pdfs = [f for f in os.listdir(directory) if f.lower().endswith(".pdf")]  # Skip non-PDF files
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async with http:  # 🔹 Closes the shared Crossref connections when done
+        async def bounded_process(filename):
+            async with sem:
+                await process(filename, known_dois, bulk_writer, manifest)
+
+        tasks = [bounded_process(f) for f in pdfs]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    # 🔥 Send all queued article writes to Firestore
+    bulk_writer.flush()
+
+    # ❌ Report articles that failed without aborting the others
+    for filename, result in zip(pdfs, results):
+        if isinstance(result, Exception):
+            print(f"❌ Processing {filename} failed: {result}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +1,10 @@
 import csv
 import os
 from collections import defaultdict
+from itertools import groupby
+
+# Required columns of a criteria CSV file: description, level, MoSCoW assessment, attribute
+CSV_COLUMNS = ["Criterion", "Class", "MoSCoW", "Detailed criterion"]
 
 class Criterion:
     """Represents a single quality criterion for a research method."""
@@ -28,38 +32,42 @@ class CriteriaStore:
     """Stores and manages criteria for multiple research methods."""
 
     def __init__(self):
-        self.criteria = defaultdict(set)  # Key: research method, Value: set of Criterion objects
+        self.criteria = defaultdict(dict)  # Key: research method, Value: dict of description -> Criterion
 
     def load_from_csv(self, file_path: str):
         """Loads criteria from a CSV file using filename as research method."""
         research_method = os.path.splitext(os.path.basename(file_path))[0]
 
-        with open(file_path, mode="r", encoding="utf-8") as file:
-            reader = csv.reader(file)
-            next(reader)  # Skip header
+        # utf-8-sig strips the byte order mark that Excel writes at the start of CSV files
+        with open(file_path, mode="r", encoding="utf-8-sig") as file:
+            reader = csv.DictReader(file)
+
+            missing_columns = [column for column in CSV_COLUMNS if column not in (reader.fieldnames or [])]
+            if missing_columns:
+                print(f"Skipping {file_path}: missing columns {missing_columns}, got {reader.fieldnames}")
+                return
+
+            # Rows of one criterion are contiguous, so each group builds its Criterion in one pass
+            for description, rows in groupby(reader, key=lambda row: row["Criterion"]):
+                criterion = None
 
-            for row in reader:
-                if len(row) != 4:
-                    print(f"Skipping malformed row: {row}")
-                    continue
+                for row in rows:
+                    if None in row or None in row.values():
+                        print(f"Skipping malformed row: {row}")
+                        continue
 
-                description, level, moscow, attribute = row
-                self.add_criterion(research_method, description, level, moscow, attribute)
+                    if criterion is None:
+                        criterion = self.criteria[research_method].setdefault(description, Criterion(description, row["Class"]))
+                    criterion.add_attribute(row["MoSCoW"], row["Detailed criterion"])
 
     def add_criterion(self, research_method: str, description: str, level: str, moscow: str, attribute: str):
         """Adds a criterion, ensuring descriptions are preserved."""
-        existing_criterion = next((c for c in self.criteria[research_method] if c.description == description), None)
-
-        if existing_criterion:
-            existing_criterion.add_attribute(moscow, attribute)
-        else:
-            new_criterion = Criterion(description, level)
-            new_criterion.add_attribute(moscow, attribute)
-            self.criteria[research_method].add(new_criterion)
+        criterion = self.criteria[research_method].setdefault(description, Criterion(description, level))
+        criterion.add_attribute(moscow, attribute)
 
     def get_criteria_for_method(self, research_method: str):
         """Retrieves all criteria for a given research method."""
-        return [c.to_dict() for c in self.criteria.get(research_method, [])]
+        return [c.to_dict() for c in self.criteria.get(research_method, {}).values()]
 
     def is_criteria_available(self, research_method: str):
         """
@@ -84,8 +92,7 @@ class CriteriaStore:
             """
             Generates a structured prompt for checking whether an article meets a specific criterion.
             """
-            criteria_set = self.criteria.get(research_method, [])
-            selected_criterion = next((c for c in criteria_set if c.description == criterion_description), None)
+            selected_criterion = self.criteria.get(research_method, {}).get(criterion_description)
 
             if not selected_criterion:
                 return f"No criterion found for {criterion_description} under {research_method}."
@@ -111,11 +118,44 @@ class CriteriaStore:
             
             return prompt
 
+    def generate_batched_prompt(self, research_method: str):
+        """
+        Generates a single structured prompt that checks all criteria of a research method at once.
+        Criteria are numbered in the order returned by get_criteria_for_method.
+        """
+        criteria_by_description = self.criteria.get(research_method, {})
+
+        if not criteria_by_description:
+            return f"No criteria found under {research_method}."
+
+        prompt = "Please check if the article meets each of the following numbered criteria.\n"
+
+        for i, criterion in enumerate(criteria_by_description.values(), start=1):
+            # Group attributes by MoSCoW level
+            must_have = [attr for level, attr in criterion.attributes if level.lower() == "must have"]
+            other_criteria = [attr for level, attr in criterion.attributes if level.lower() != "must have"]
+
+            prompt += f"\n{i}. {criterion.description}\n"
+            prompt += "It must at least meet the following Must Have criteria:\n"
+
+            if must_have:
+                prompt += "\n".join(f"- {c}" for c in must_have) + "\n"
+            else:
+                prompt += "- No explicitly defined 'Must Have' criteria.\n"
+
+            if other_criteria:
+                prompt += "If one of these is missing, it can be replaced by at least two of the following:\n"
+                prompt += "\n".join(f"- {c}" for c in other_criteria) + "\n"
+
+        prompt += '\nReturn only JSON: {"answers": [{"id": <int>, "answer": "Yes" or "No"}]}, with one object per criterion.'
+
+        return prompt
+
     def print_all_criteria(self):
         """Prints all research methods and their associated criteria in full detail."""
-        for research_method, criteria_set in self.criteria.items():
+        for research_method, criteria_by_description in self.criteria.items():
             print(f"\n🔹 Research Method: {research_method}")
-            for criterion in criteria_set:
+            for criterion in criteria_by_description.values():
                 print(f"  - Description: {criterion.description}")
                 print(f"    Level: {criterion.level}")
                 print(f"    Attributes:")